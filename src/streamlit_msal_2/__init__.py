@@ -7,6 +7,8 @@ Functions:
     refresh_obo_token: Checks if the user is logged in and refreshes the
         obo access token if necessary. This can be only used after configure
         the `init_auth` function with `init_obo_process=True`.
+    reload_env: Reloads the default `CLIENT_ID`, `TENANT_ID` and
+        `CLIENT_SECRET` from the environment variables.
 
 Examples:
     >>> import streamlit as st
@@ -24,13 +26,76 @@ Examples:
 """
 
 import os
-import requests
 import datetime
+import functools
+import http.cookiejar
+import logging
+import threading
 import time
+from typing import TYPE_CHECKING
+from urllib.parse import urlencode
 
 import streamlit as st
-from loguru import logger
-from streamlit_msal import Msal
+
+try:
+    from orjson import loads as _loads
+except ImportError:
+    from json import loads as _loads
+
+if TYPE_CHECKING:
+    import requests
+
+logger = logging.getLogger(__name__)
+
+# (connect, read) timeout in seconds of the token endpoint calls
+_TIMEOUT = (3.05, 10)
+
+# default credentials, resolved once from the environment variables, see
+# `reload_env`
+_DEFAULT_CLIENT_ID = os.environ.get("CLIENT_ID")
+_DEFAULT_TENANT_ID = os.environ.get("TENANT_ID")
+_DEFAULT_CLIENT_SECRET = os.environ.get("CLIENT_SECRET")
+
+# payload fields shared by all requests of the same grant type
+_OBO_BASE_PAYLOAD = {
+    "grant_type": "urn:ietf:params:oauth:grant-type:jwt-bearer",
+    "requested_token_use": "on_behalf_of",
+}
+_REFRESH_BASE_PAYLOAD = {"grant_type": "refresh_token"}
+
+
+def reload_env() -> None:
+    """
+    Reloads the default `CLIENT_ID`, `TENANT_ID` and `CLIENT_SECRET` from
+    the environment variables. The environment variables are read once at
+    import time, variables missing at import time are read again when they
+    are needed, e.g. if set by `load_dotenv()` after the import. Call this
+    function if the values are changed after the import.
+    """
+    global _DEFAULT_CLIENT_ID, _DEFAULT_TENANT_ID, _DEFAULT_CLIENT_SECRET
+    _DEFAULT_CLIENT_ID = os.environ.get("CLIENT_ID")
+    _DEFAULT_TENANT_ID = os.environ.get("TENANT_ID")
+    _DEFAULT_CLIENT_SECRET = os.environ.get("CLIENT_SECRET")
+
+
+def _resolve_credentials(
+    tenant_id: str = None, client_id: str = None, client_secret: str = None
+) -> tuple:
+    """
+    Fills the missing credentials with the defaults from the environment
+    variables. The environment variables missing at import time are read
+    again, in case they are set afterwards.
+
+    Returns:
+        tuple: The `tenant_id`, `client_id` and `client_secret`.
+    """
+    return (
+        tenant_id or _DEFAULT_TENANT_ID or os.environ.get("TENANT_ID"),
+        client_id or _DEFAULT_CLIENT_ID or os.environ.get("CLIENT_ID"),
+        client_secret
+        or _DEFAULT_CLIENT_SECRET
+        or os.environ.get("CLIENT_SECRET"),
+    )
 
 
 def init_auth(
@@ -66,6 +131,10 @@ def init_auth(
     variables as `OBO_TOKEN`, and also `st.session_state.obo_token` for easy
     access.
 
+    The `TENANT_ID`, `CLIENT_ID` and `CLIENT_SECRET` environment variables
+    are read once at import time, or when first needed if they are not set
+    at import time. Call `reload_env` if they are changed afterwards.
+
     Args:
         user_roles (dict): A dictionary containing the required roles. The keys
             are the role names and the values are the role descriptions. The
@@ -111,8 +180,7 @@ def init_auth(
         >>> email_suffix = "@microsoft.com"
         >>> init_auth(user_roles, tenant_id, client_id, email_suffix)
     """
-    client_id = client_id or os.getenv("CLIENT_ID", None)
-    tenant_id = tenant_id or os.getenv("TENANT_ID", None)
+    tenant_id, client_id, _ = _resolve_credentials(tenant_id, client_id)
 
     if tenant_id is None or client_id is None:
         st.warning(
@@ -122,6 +190,9 @@ def init_auth(
         )
         st.stop()
 
+    # imported lazily, only needed once the credentials are checked
+    from streamlit_msal import Msal  # pylint: disable=import-outside-toplevel
+
     with st.sidebar:
         auth_data = Msal.initialize_ui(
             client_id=client_id,
@@ -141,7 +212,8 @@ def init_auth(
         if email_suffix is not None:
             # in case to match with enterprise email suffix
             # e.g., @microsoft.com
-            if email_suffix not in auth_data["account"]["username"]:
+            username = auth_data["account"]["username"].lower()
+            if not username.endswith(email_suffix.lower()):
                 st.warning("Invalid account! No permission found for you")
                 st.stop()
 
@@ -154,35 +226,47 @@ def init_auth(
             )
             st.stop()
 
-        if "auth_data" not in st.session_state:
-            # set the names to the session state
-            st.session_state.auth_data = auth_data
-            st.session_state.username = auth_data["account"]["name"]
+        if _is_authenticated(auth_data, init_obo_process):
+            # the same account has been set up in a previous rerun, and the
+            # obo token (if any) is still valid, nothing else to do
+            return
+
+        cached = st.session_state.get("auth_data")
+        if cached and not _is_same_account(cached, auth_data):
+            # another account signed in, drop the previous obo token
+            st.session_state.pop("obo_info", None)
 
-            st.session_state.roles = auth_data["idTokenClaims"]["roles"]
+        # set the names to the session state
+        st.session_state.auth_data = auth_data
+        st.session_state.username = auth_data["account"]["name"]
+
+        st.session_state.roles = auth_data["idTokenClaims"]["roles"]
 
         if init_obo_process:
-            obo_token = _acquire_access_token_obo(
-                auth_data["idToken"],
+            # try the cached obo token first, only go through the obo
+            # exchange when there is no valid token in the session state
+            obo_info = _acquire_token_silent(
                 tenant_id=tenant_id,
                 client_id=client_id,
                 client_secret=client_secret,
                 downstream_scope=downstream_scope,
-                retry_times=retry_times,
             )
-            if not obo_token:
-                st.write(
-                    "Failed acquiring token, refresh the page and login again!"
+            if obo_info is None:
+                obo_token = _acquire_access_token_obo(
+                    auth_data["idToken"],
+                    tenant_id=tenant_id,
+                    client_id=client_id,
+                    client_secret=client_secret,
+                    downstream_scope=downstream_scope,
+                    retry_times=retry_times,
                 )
-                st.stop()
-            st.session_state.obo_info = {
-                "access_token": obo_token.get("access_token"),
-                "refresh_token": obo_token.get("refresh_token"),
-                "expires_at": datetime.datetime.now()
-                + datetime.timedelta(seconds=obo_token.get("expires_in")),
-            }
-            os.environ["OBO_TOKEN"] = obo_token.get("access_token")
-            st.session_state.obo_token = obo_token.get("access_token")
+                if not obo_token:
+                    st.write(
+                        "Failed acquiring token, "
+                        "refresh the page and login again!"
+                    )
+                    st.stop()
+                _store_obo_info(obo_token)
 
 
 def refresh_obo_token(
@@ -190,7 +274,7 @@ def refresh_obo_token(
     client_id: str = None,
     client_secret: str = None,
     downstream_scope=None,
-) -> str:
+) -> dict | None:
     """
     Checks if the user is logged in and refreshes the obo access token if
     necessary.
@@ -202,21 +286,94 @@ def refresh_obo_token(
     `True`, in the background, it uses the `st.session_state.obo_info` in
     user sign in process.
 
+    If the cached token cannot be refreshed, e.g. no refresh token is
+    returned without the `offline_access` scope, a new obo token is acquired
+    with the id token of the signed-in user. If this fails as well, the
+    `st.session_state.obo_token` and the `OBO_TOKEN` are cleared.
+
     Returns:
-        str: The refreshed access token.
+        dict | None: The refreshed obo token information, or None if the
+            user is not logged in or the token cannot be acquired.
 
     Raises:
         None
     """
-    tokens = st.session_state.obo_info
+    # imported lazily, only needed on the obo path
+    import requests  # pylint: disable=import-outside-toplevel
 
-    if not tokens:
+    if not st.session_state.get("obo_info"):
         st.write("User not logged in")
         return None
 
-    if tokens.get("expires_at") < datetime.datetime.now():
-        logger.info("Refreshing access token...")
+    try:
+        obo_info = _acquire_token_silent(
+            tenant_id=tenant_id,
+            client_id=client_id,
+            client_secret=client_secret,
+            downstream_scope=downstream_scope,
+        )
+        if obo_info is not None:
+            return obo_info
 
+        # the cached token cannot be refreshed, go through the obo exchange
+        obo_token = _acquire_access_token_obo(
+            st.session_state.auth_data["idToken"],
+            tenant_id=tenant_id,
+            client_id=client_id,
+            client_secret=client_secret,
+            downstream_scope=downstream_scope,
+        )
+    except (requests.exceptions.RequestException, ValueError) as error:
+        # ValueError also covers the non-json responses, e.g. html error pages
+        logger.error("Token refresh failed: %s", error)
+        obo_token = None
+
+    if not obo_token:
+        st.session_state.obo_token = None
+        os.environ.pop("OBO_TOKEN", None)
+        st.write("Failed refreshing token, refresh the page and login again!")
+        return None
+    return _store_obo_info(obo_token)
+
+
+def _acquire_token_silent(
+    tenant_id: str = None,
+    client_id: str = None,
+    client_secret: str = None,
+    downstream_scope=None,
+):
+    """
+    Acquires the obo token from the `st.session_state.obo_info` cache. The
+    cached token is returned directly if it is not expired yet, otherwise it
+    is refreshed with the cached refresh token.
+
+    Returns:
+        dict: The obo token information, or None if there is no valid token
+            in the cache and it cannot be refreshed.
+
+    Raises:
+        None
+    """
+    tokens = st.session_state.get("obo_info")
+    if not tokens:
+        return None
+
+    if tokens["_refresh_at"] > time.monotonic():
+        return tokens
+
+    with _get_refresh_lock():
+        # the token may have been refreshed while waiting for the lock
+        tokens = st.session_state.get("obo_info")
+        if not tokens:
+            return None
+
+        if tokens["_refresh_at"] > time.monotonic():
+            return tokens
+
+        if not tokens.get("refresh_token"):
+            return None
+
+        logger.info("Refreshing access token...")
         new_tokens = _refresh_access_token(
             tenant_id=tenant_id,
             client_id=client_id,
@@ -224,14 +381,54 @@ def refresh_obo_token(
             downstream_scope=downstream_scope,
             refresh_token=tokens.get("refresh_token"),
         )
-        tokens["access_token"] = new_tokens.get("access_token")
-        tokens["refresh_token"] = new_tokens.get("refresh_token")
-        tokens["expires_at"] = datetime.datetime.now() + datetime.timedelta(
-            seconds=new_tokens.get("expires_in")
-        )
-        st.session_state.obo_info = tokens
-        os.environ["OBO_TOKEN"] = tokens["access_token"]
-        st.session_state.obo_token = tokens["access_token"]
+        if "access_token" not in new_tokens:
+            logger.error(
+                "Token refresh failed: %s",
+                new_tokens.get("error_description"),
+            )
+            return None
+        return _store_obo_info(new_tokens)
+
+
+def _get_refresh_lock() -> threading.Lock:
+    """
+    Gets the lock serializing the token refresh of the current user session.
+    The lock is stored in the session state next to the token it guards, so
+    the refreshes of different users never wait for each other, and the lock
+    is released together with the user session.
+
+    Returns:
+        threading.Lock: The refresh lock.
+    """
+    return st.session_state.setdefault("_obo_refresh_lock", threading.Lock())
+
+
+def _store_obo_info(obo_token: dict) -> dict:
+    """
+    Stores the obo token response from the token endpoint in the session
+    state, and the access token in the `OBO_TOKEN` environment variable.
+
+    Args:
+        obo_token (dict): The response from the token endpoint.
+
+    Returns:
+        dict: The stored obo token information.
+    """
+    access_token = obo_token["access_token"]
+    refresh_token = obo_token.get("refresh_token")
+    expires_in = obo_token["expires_in"]
+
+    st.session_state.obo_info = {
+        "access_token": access_token,
+        "refresh_token": refresh_token,
+        "expires_at": datetime.datetime.now()
+        + datetime.timedelta(seconds=expires_in),
+        # monotonic deadline to refresh the token, one minute before it
+        # expires, not affected by wall-clock jumps
+        "_refresh_at": time.monotonic() + expires_in - 60,
+    }
+    os.environ["OBO_TOKEN"] = access_token
+    st.session_state.obo_token = access_token
     return st.session_state.obo_info
 
 
@@ -243,7 +440,8 @@ def _refresh_access_token(
     refresh_token=None,
 ):
     """
-    Refreshes the access token using the provided refresh token.
+    Refreshes the access token using the provided refresh token. Requests
+    failed due to throttling or server errors are retried up to 5 times.
 
     Args:
         refresh_token (str): The refresh token to use for refreshing the
@@ -255,9 +453,9 @@ def _refresh_access_token(
     Raises:
         None
     """
-    tenant_id = tenant_id or os.getenv("TENANT_ID", None)
-    client_id = client_id or os.getenv("CLIENT_ID", None)
-    client_secret = client_secret or os.getenv("CLIENT_SECRET", None)
+    tenant_id, client_id, client_secret = _resolve_credentials(
+        tenant_id, client_id, client_secret
+    )
     if tenant_id is None or client_id is None or client_secret is None:
         raise ValueError(
             "Tenant ID, Client ID, and Client Secret cannot be None!"
@@ -266,19 +464,60 @@ def _refresh_access_token(
     if refresh_token is None:
         refresh_token = st.session_state.obo_info["refresh_token"]
     payload = {
+        **_REFRESH_BASE_PAYLOAD,
         "client_id": client_id,
         "client_secret": client_secret,
-        "grant_type": "refresh_token",
         "refresh_token": refresh_token,
         "scope": downstream_scope,
     }
-    response = requests.post(
-        "https://login.microsoftonline.com/"
-        + tenant_id
-        + "/oauth2/v2.0/token",
-        data=payload,
+    response = _get_session(retry_times=5).post(
+        _token_endpoint(tenant_id), data=payload, timeout=_TIMEOUT
+    )
+    return _loads(response.content)
+
+
+def _is_authenticated(auth_data: dict, init_obo_process: bool) -> bool:
+    """
+    Check if the signed-in account has already been stored in the session
+    state by `init_auth` in a previous rerun, and the obo token (only when
+    `init_obo_process=True`) is still valid. The email suffix and role checks
+    are not covered, they depend on the arguments of the current call.
+
+    Args:
+        auth_data (dict): The sign-in information from the msal component.
+        init_obo_process (bool): Whether the obo token is required.
+
+    Returns:
+        bool: True if the session state writes and the obo token acquisition
+            can be skipped, False otherwise.
+    """
+    cached = st.session_state.get("auth_data")
+    if not cached or not _is_same_account(cached, auth_data):
+        return False
+    if not init_obo_process:
+        return True
+
+    obo_info = st.session_state.get("obo_info") or {}
+    return obo_info.get("_refresh_at", 0) > time.monotonic()
+
+
+def _is_same_account(auth_data: dict, other: dict) -> bool:
+    """
+    Check if two sign-in information from the msal component belong to the
+    same account. Only the stable account id is compared, other fields such
+    as the claims may change for the same account.
+
+    Args:
+        auth_data (dict): The sign-in information from the msal component.
+        other (dict): The other sign-in information.
+
+    Returns:
+        bool: True if both belong to the same account, False otherwise.
+    """
+    return (
+        auth_data["account"]["homeAccountId"]
+        == other["account"]["homeAccountId"]
     )
-    return response.json()
 
 
 def _check_role(auth: dict, user_roles: dict) -> bool:
@@ -292,16 +531,80 @@ def _check_role(auth: dict, user_roles: dict) -> bool:
         bool: True if the authentication object has the required role, False
             otherwise.
     """
-    if not auth:
-        return False
-    if "roles" not in auth:
+    roles = auth.get("roles") if auth else None
+    if not roles:
         return False
 
-    for role in user_roles.values():
-        if role in auth["roles"]:
-            return True
+    return not set(user_roles.values()).isdisjoint(roles)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_session(retry_times: int = 5) -> "requests.Session":
+    """
+    Gets the shared session for the token endpoint calls, created on the
+    first call for each `retry_times`. The cached session survives the
+    streamlit reruns, so the TCP/TLS connections are reused across reruns.
+    The session is shared by all users, so no cookies are stored.
+
+    Failed requests due to throttling or server errors are retried with an
+    exponential backoff with jitter, honouring the `Retry-After` header up to
+    30 seconds.
+
+    Args:
+        retry_times (int): The number of times to retry a failed request.
 
-    return False
+    Returns:
+        requests.Session: The shared session.
+    """
+    # imported lazily, only needed on the obo path
+    # pylint: disable=import-outside-toplevel
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    class _CappedRetry(Retry):
+        """Retry waiting at most 30 seconds for the `Retry-After` header."""
+
+        def get_retry_after(self, response):
+            retry_after = super().get_retry_after(response)
+            if retry_after is None:
+                return None
+            return min(retry_after, 30)
+
+    retry = _CappedRetry(
+        total=retry_times,
+        backoff_factor=0.5,
+        backoff_jitter=1.0,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["POST"],
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    session = requests.Session()
+    # the session is shared by all users, never keep the cookies set by the
+    # token endpoint for one user and replay them for the others
+    session.cookies.set_policy(
+        http.cookiejar.DefaultCookiePolicy(allowed_domains=[])
+    )
+    session.mount(
+        "https://",
+        HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=retry),
+    )
+    return session
+
+
+@functools.lru_cache(maxsize=8)
+def _token_endpoint(tenant_id: str) -> str:
+    """
+    Gets the token endpoint of the given tenant.
+
+    Args:
+        tenant_id (str): The tenant ID in Microsoft Azure.
+
+    Returns:
+        str: The url of the token endpoint.
+    """
+    return f"https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0/token"
 
 
 def _acquire_access_token_obo(
@@ -324,41 +627,44 @@ def _acquire_access_token_obo(
     Raises:
         requests.exceptions.RequestException
     """
-    times = 1
-    tenant_id = tenant_id or os.getenv("TENANT_ID", None)
-    client_id = client_id or os.getenv("CLIENT_ID", None)
-    client_secret = client_secret or os.getenv("CLIENT_SECRET", None)
+    # imported lazily, only needed on the obo path
+    import requests  # pylint: disable=import-outside-toplevel
+
+    tenant_id, client_id, client_secret = _resolve_credentials(
+        tenant_id, client_id, client_secret
+    )
 
     if tenant_id is None or client_id is None or client_secret is None:
         raise ValueError(
             "Tenant ID, Client ID, and Client Secret cannot be None!"
         )
 
-    token_url = (
-        f"https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0/token"
-    )
+    token_url = _token_endpoint(tenant_id)
 
     headers = {"Content-Type": "application/x-www-form-urlencoded"}
     data = {
+        **_OBO_BASE_PAYLOAD,
         "client_id": client_id,
         "client_secret": client_secret,
-        "grant_type": "urn:ietf:params:oauth:grant-type:jwt-bearer",
-        "requested_token_use": "on_behalf_of",
         "scope": downstream_scope,
         "assertion": auth_id_token,
     }
+    # encode the form body once, it is resent as is on retries
+    body = urlencode(
+        {key: value for key, value in data.items() if value is not None}
+    ).encode("ascii")
 
-    while times < retry_times:
-        response = requests.post(token_url, headers=headers, data=data)
-        if response.status_code == 200:
-            return response.json()
-        else:
-            logger.error(
-                f"Token acquisition failed: {response.status_code} - {response.text}"
-            )
-            time.sleep(5)
-            times += 1
+    response = _get_session(retry_times).post(
+        token_url, headers=headers, data=body, timeout=_TIMEOUT
+    )
+    if response.status_code == 200:
+        return _loads(response.content)
 
+    logger.error(
+        "Token acquisition failed: %s - %s",
+        response.status_code,
+        response.text,
+    )
     raise requests.exceptions.RequestException(
-        f"Error acquiring token after {times} attempts"
+        f"Error acquiring token: {response.status_code}"
     )